@@ -0,0 +1,13 @@
+"""Значения по умолчанию для ETL.
+
+Модуль без зависимостей: его импортирует и точка входа, и сервисы,
+поэтому значения не расходятся, а импорты в main.py остаются ленивыми.
+"""
+ES_INDEX_NAME = 'movies'
+POLL_INTERVAL = 60
+BATCH_SIZE = 100
+CONCURRENCY = 1
+LOG_FILE = 'logs.log'
+LOG_LEVEL = 'INFO'
+# Число попыток backoff в разовых режимах; daemon повторяет бесконечно.
+ONESHOT_MAX_ATTEMPTS = 5
@@ -3,7 +3,21 @@ import time
 from functools import wraps
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+
+# Максимальное число попыток для всех функций под backoff.
+# None - повторять бесконечно (режим daemon).
+max_attempts = None
+
+
+def set_max_attempts(value):
+    """Ограничивает число попыток; None или 0 снимает ограничение."""
+    global max_attempts
+    max_attempts = value or None
+
+
+def _give_up(attempt):
+    """Проверяет, исчерпаны ли попытки (attempt считается с нуля)."""
+    return max_attempts is not None and attempt + 1 >= max_attempts
 
 
 def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
@@ -22,6 +36,8 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
     Формула:
         t = start_sleep_time * (factor ^ attempt), если t < border_sleep_time
         t = border_sleep_time, иначе
+
+    После max_attempts неудачных попыток исключение пробрасывается дальше.
     :return: результат выполнения функции
     """
     def func_wrapper(func):
@@ -36,6 +52,8 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
                     logger.error(
                         f'Попытка {attempt} выполнить функцию {func.__name__},'
                         f' вызавала ошибку: {err}')
+                    if _give_up(attempt):
+                        raise
                     if delay < border_sleep_time:
                         delay = start_sleep_time * (factor ** attempt)
                     else:
@@ -61,6 +79,8 @@ def pg_backoff(start_sleep_time=25, factor=5, border_sleep_time=1):
         factor (int, optional): Слагаемое/Вычитаемое число от текущей задержки.
         По умолчанию 5.
         border_sleep_time (int, optional): Ниж. порог задержки. По умолчанию 1.
+
+    После max_attempts неудачных попыток исключение пробрасывается дальше.
     """
     def func_wrapper(func):
         @wraps(func)
@@ -77,6 +97,8 @@ def pg_backoff(start_sleep_time=25, factor=5, border_sleep_time=1):
                             f'Попытка {attempt + 1} '
                             f'выполнить функцию {func.__name__}, '
                             f'вызвала ошибку: {err}. Delay = {delay}')
+                        if _give_up(attempt):
+                            raise
                         time.sleep(delay)
                         attempt += 1
                 else:
@@ -90,6 +112,8 @@ def pg_backoff(start_sleep_time=25, factor=5, border_sleep_time=1):
                                 f'функцию {func.__name__},'
                                 f' вызавала ошибку: {err}. Delay = {delay}'
                             )
+                            if _give_up(attempt):
+                                raise
                             time.sleep(delay)
                             attempt += 1
         return inner
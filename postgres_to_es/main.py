@@ -1,34 +1,54 @@
+"""Точка входа ETL: перенос фильмов из PostgreSQL в Elasticsearch.
+
+Режимы запуска:
+    once      - один проход по изменениям с последнего last_modified;
+    daemon    - бесконечный цикл с паузой POLL_INTERVAL (по умолчанию);
+    backfill  - полный перенос без учёта сохранённого состояния;
+    reindex   - полный перенос в новый индекс и переключение алиаса;
+    verify    - сверка числа фильмов в PostgreSQL и Elasticsearch.
+
+Тяжёлые зависимости (psycopg, redis, elasticsearch) импортируются
+только внутри режимов, чтобы `--help` и разовые запуски стартовали быстро.
+"""
+import argparse
+import datetime as dt
 import logging
+import os
+import sys
 import time
 from contextlib import closing
+from typing import List, Tuple
 
-import redis
-from db.backoff import backoff
-from db.connect_to_dbs import (connect_to_elastic, connect_to_pg,
-                               connect_to_redis)
-from db.es_schema import MAPPINGS, SETTINGS
-from elasticsearch.exceptions import RequestError
-from services.db_classes import ETL
-from services.state import RedisStorage, State
-
-logging.basicConfig(
-    level=logging.INFO,
-    filename="logs.log",
-    format=(
-        '%(asctime)s - %(name)s - %(levelname)s '
-        '- %(filename)s:%(lineno)d - %(message)s'
-    )
-)
-logging.info("Логи работают")
+from config import (BATCH_SIZE, CONCURRENCY, ES_INDEX_NAME, LOG_FILE,
+                    LOG_LEVEL, ONESHOT_MAX_ATTEMPTS, POLL_INTERVAL)
+from db.backoff import backoff, set_max_attempts
 
-ES_INDEX_NAME = 'movies'
-POLL_INTERVAL = 60
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+def setup_logging(log_file: str, level: str) -> None:
+    """Настраивает логирование в файл или stderr, если файл не задан."""
+    logging.basicConfig(
+        level=level,
+        filename=log_file or None,
+        format=(
+            '%(asctime)s - %(name)s - %(levelname)s '
+            '- %(filename)s:%(lineno)d - %(message)s'
+        )
+    )
+    logging.info("Логи работают")
 
 
 @backoff()
 def create_index(es, index_name: str, mappings: dict = None,
                  settings: dict = None):
-    """Создает индекс в Elasticsearch."""
+    """Создает индекс в Elasticsearch.
+
+    Ошибки логируются и пробрасываются дальше: без MAPPINGS/SETTINGS
+    bulk создал бы индекс с динамической схемой.
+    """
+    from elasticsearch.exceptions import RequestError
+
     try:
         if not es.indices.exists(index=index_name):
             body = {}
@@ -43,51 +63,282 @@ def create_index(es, index_name: str, mappings: dict = None,
             logging.warning(f"Индекс '{index_name}' уже существует.")
     except RequestError as err:
         logging.error(f"Ошибка при создании индекса '{index_name}': {err}")
+        raise
     except Exception as err:
         logging.error(
             f"Неожиданная ошибка при создании индекса '{index_name}': {err}",
             exc_info=True
         )
+        raise
+
+
+def init_index(index_name: str, exist_ok: bool = True):
+    """Создаёт индекс со схемой из es_schema, если его ещё нет.
+
+    При exist_ok=False уже существующий индекс считается ошибкой.
+    """
+    from db.connect_to_dbs import connect_to_elastic
+    from db.es_schema import MAPPINGS, SETTINGS
+
+    with closing(connect_to_elastic()) as es:
+        if not exist_ok and es.indices.exists(index=index_name):
+            raise RuntimeError(f"Индекс '{index_name}' уже существует.")
+        create_index(es, index_name, MAPPINGS, SETTINGS)
+
+
+@backoff()
+def switch_alias(alias: str, index_name: str) -> List[str]:
+    """Атомарно переводит алиас на index_name.
+
+    Если под именем алиаса лежит обычный индекс (установка до reindex),
+    он заменяется алиасом в том же запросе.
+
+    Returns:
+        List[str]: индексы, с которых снят алиас; их можно удалять.
+    """
+    from db.connect_to_dbs import connect_to_elastic
+
+    with closing(connect_to_elastic()) as es:
+        old_indices = []
+        actions = []
+        if es.indices.exists_alias(name=alias):
+            old_indices = [
+                index for index in es.indices.get_alias(name=alias)
+                if index != index_name
+            ]
+            actions += [
+                {'remove': {'index': index, 'alias': alias}}
+                for index in old_indices
+            ]
+        elif es.indices.exists(index=alias):
+            actions.append({'remove_index': {'index': alias}})
+        actions.append({'add': {'index': index_name, 'alias': alias}})
+        es.indices.update_aliases(actions=actions)
+        logging.info(f"Алиас '{alias}' переключён на '{index_name}'.")
+    return old_indices
+
+
+@backoff()
+def drop_index(index_name: str):
+    """Удаляет индекс, если он существует."""
+    from db.connect_to_dbs import connect_to_elastic
+
+    with closing(connect_to_elastic()) as es:
+        if es.indices.exists(index=index_name):
+            es.indices.delete(index=index_name)
+            logging.info(f"Индекс '{index_name}' удалён.")
+
+
+def run_etl(args, since: dt.datetime = None, index: str = None,
+            save_state: bool = True) -> Tuple[int, dt.datetime]:
+    """Выполняет один проход ETL со свежими подключениями.
+
+    Returns:
+        Tuple[int, datetime]: число фильмов, которые не удалось загрузить,
+        и достигнутый last_modified.
+    """
+    from db.connect_to_dbs import (connect_to_elastic, connect_to_pg,
+                                   connect_to_redis)
+    from services.db_classes import ETL
+    from services.state import RedisStorage, State
+
+    with closing(
+        connect_to_pg()
+    ) as pg_conn, closing(
+        connect_to_elastic()
+    ) as es_conn, closing(
+        connect_to_redis()
+    ) as re_conn:
+
+        state = State(RedisStorage(re_conn))
+        pg_conn.autocommit = False
+        etl = ETL(
+            pg_conn, es_conn, index or args.index, state,
+            batch_size=args.batch_size, concurrency=args.concurrency
+        )
+        _, failed, watermark = etl.etl(since=since, save_state=save_state)
+        pg_conn.commit()
+    logging.info('PostgreSQL подключение закрыто.')
+    if failed:
+        logging.error(f'Не удалось загрузить {failed} фильмов.')
+    return failed, watermark
+
+
+def rewind_state(watermark: dt.datetime):
+    """Откатывает сохранённый last_modified не дальше watermark."""
+    from db.connect_to_dbs import connect_to_redis
+    from services.db_classes import rewind_last_modified
+    from services.state import RedisStorage, State
+
+    with closing(connect_to_redis()) as re_conn:
+        rewind_last_modified(State(RedisStorage(re_conn)), watermark)
+
+
+def run_once(args) -> int:
+    init_index(args.index)
+    failed, _ = run_etl(args)
+    return 1 if failed else 0
+
+
+def run_daemon(args) -> int:
+    init_index(args.index)
+    while True:
+        try:
+            run_etl(args)
+        except Exception as err:
+            logging.error(
+                f'Ошибка в ETL цикле: {err}',
+                exc_info=True
+            )
+        logging.info(
+            'Ждём POLL INTERVAL перед перезапуском цикла: '
+            f'{args.poll_interval} секунд.'
+        )
+        time.sleep(args.poll_interval)
 
 
-def main():
+def run_backfill(args) -> int:
+    init_index(args.index)
+    failed, _ = run_etl(
+        args, since=dt.datetime.min.replace(tzinfo=dt.timezone.utc))
+    return 1 if failed else 0
+
+
+def run_reindex(args) -> int:
+    """Строит новый индекс и переключает на него алиас args.index.
+
+    Пока идёт загрузка, поиск продолжает работать по старому индексу.
+    Общий last_modified во время загрузки не меняется, а после
+    переключения откатывается до позиции reindex: изменения, которые
+    daemon успел записать в старый индекс, будут перечитаны в новый.
+    """
+    new_index = (
+        f'{args.index}_{dt.datetime.now(dt.timezone.utc):%Y%m%d%H%M%S%f}')
+    init_index(new_index, exist_ok=False)
+    switched = False
     try:
-        @backoff()
-        def init_index():
-            with closing(connect_to_elastic()) as es:
-                create_index(es, ES_INDEX_NAME, MAPPINGS, SETTINGS)
-        init_index()
-        while True:
+        failed, watermark = run_etl(
+            args, since=dt.datetime.min.replace(tzinfo=dt.timezone.utc),
+            index=new_index, save_state=False
+        )
+        if failed:
+            return 1
+        old_indices = switch_alias(args.index, new_index)
+        switched = True
+    finally:
+        if not switched:
+            logging.error(
+                f"Алиас '{args.index}' не переключён, индекс '{new_index}' "
+                'удаляется.'
+            )
             try:
-                with closing(
-                    connect_to_pg()
-                ) as pg_conn, closing(
-                    connect_to_elastic()
-                ) as es_conn, closing(
-                    connect_to_redis()
-                ) as re_conn:
-
-                    state = State(RedisStorage(re_conn))
-                    pg_conn.autocommit = False
-                    etl = ETL(pg_conn, es_conn, ES_INDEX_NAME, state)
-                    etl.etl()
-                    pg_conn.commit()
-                logging.info('PostgreSQL подключение закрыто.')
+                drop_index(new_index)
             except Exception as err:
                 logging.error(
-                    f'Ошибка в ETL цикле: {err}',
-                    exc_info=True
-                )
-            logging.info(
-                'Ждём POLL INTERVAL перед перезапуском цикла: '
-                f'{POLL_INTERVAL} секунд.'
-            )
-            time.sleep(POLL_INTERVAL)
-    except redis.exceptions.ConnectionError as err:
-        logging.error(f"Ошибка подключения к Redis: {err}")
+                    f"Не удалось удалить индекс '{new_index}': {err}")
+    rewind_state(watermark)
+    for index in old_indices:
+        drop_index(index)
+    return 0
+
+
+def run_verify(args) -> int:
+    """Сверяет число фильмов в Postgres и документов в индексе."""
+    from db.connect_to_dbs import connect_to_elastic, connect_to_pg
+    from services.queries import count_query
+
+    with closing(connect_to_pg()) as pg_conn:
+        with pg_conn.cursor() as cursor:
+            cursor.execute(count_query)
+            pg_count = cursor.fetchone()[0]
+    with closing(connect_to_elastic()) as es:
+        es.indices.refresh(index=args.index)
+        es_count = es.count(index=args.index)['count']
+
+    logging.info(f'Фильмов в PostgreSQL: {pg_count}, в ES: {es_count}.')
+    print(f'postgres={pg_count} elasticsearch={es_count}')
+    return 0 if pg_count == es_count else 1
+
+
+COMMANDS = {
+    'once': run_once,
+    'daemon': run_daemon,
+    'backfill': run_backfill,
+    'reindex': run_reindex,
+    'verify': run_verify,
+}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Разбирает аргументы; значения по умолчанию берутся из окружения."""
+    env = os.environ.get
+    parser = argparse.ArgumentParser(
+        description='Перенос фильмов из PostgreSQL в Elasticsearch.'
+    )
+    parser.add_argument(
+        'command', nargs='?', choices=COMMANDS,
+        default=env('ETL_MODE', 'daemon'),
+        help='режим запуска (ETL_MODE, по умолчанию daemon)'
+    )
+    parser.add_argument(
+        '--index', default=env('ES_INDEX_NAME', ES_INDEX_NAME),
+        help='имя индекса в Elasticsearch (ES_INDEX_NAME)'
+    )
+    parser.add_argument(
+        '--batch-size', type=int,
+        default=env('ETL_BATCH_SIZE', str(BATCH_SIZE)),
+        help='размер пачки из PostgreSQL (ETL_BATCH_SIZE)'
+    )
+    parser.add_argument(
+        '--concurrency', type=int,
+        default=env('ETL_CONCURRENCY', str(CONCURRENCY)),
+        help='число параллельных bulk-запросов в ES (ETL_CONCURRENCY)'
+    )
+    parser.add_argument(
+        '--poll-interval', type=float,
+        default=env('ETL_POLL_INTERVAL', str(POLL_INTERVAL)),
+        help='пауза между циклами в режиме daemon, с (ETL_POLL_INTERVAL)'
+    )
+    parser.add_argument(
+        '--max-attempts', type=int, default=env('ETL_MAX_ATTEMPTS') or None,
+        help=(
+            'число попыток при ошибках PG/ES, 0 - без ограничения '
+            f'(ETL_MAX_ATTEMPTS, по умолчанию {ONESHOT_MAX_ATTEMPTS} '
+            'для разовых режимов и без ограничения для daemon)'
+        )
+    )
+    parser.add_argument(
+        '--log-file', default=env('ETL_LOG_FILE', LOG_FILE),
+        help='файл логов, пустая строка - stderr (ETL_LOG_FILE)'
+    )
+    parser.add_argument(
+        '--log-level', type=str.upper, choices=LOG_LEVELS,
+        default=env('ETL_LOG_LEVEL', LOG_LEVEL),
+        help='уровень логирования (ETL_LOG_LEVEL)'
+    )
+    args = parser.parse_args(argv)
+    if args.batch_size < 1 or args.concurrency < 1:
+        parser.error('--batch-size и --concurrency должны быть >= 1')
+    if args.max_attempts is not None and args.max_attempts < 0:
+        parser.error('--max-attempts должен быть >= 0')
+    if args.max_attempts is None and args.command != 'daemon':
+        args.max_attempts = ONESHOT_MAX_ATTEMPTS
+    return args
+
+
+def main(argv=None) -> int:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    args = parse_args(argv)
+    setup_logging(args.log_file, args.log_level)
+    set_max_attempts(args.max_attempts)
+    try:
+        return COMMANDS[args.command](args)
     except Exception as err:
-        logging.error(f'Возникла непредвиденная ошибка: {err}')
+        logging.error(f'Возникла непредвиденная ошибка: {err}', exc_info=True)
+        return 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,94 +1,160 @@
 import datetime as dt
 import json
 import logging
-from typing import Any, Dict, Generator, List
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
 from psycopg import connection as _connection
 
 from .queries import main_query
 from .state import State
+from config import BATCH_SIZE, CONCURRENCY
 from db.backoff import backoff
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-
-BATCH_SIZE = 100
 
 
 class ETL:
     def __init__(
-        self, pg_conn: _connection, es_conn, index_name: str, state: State
+        self, pg_conn: _connection, es_conn, index_name: str, state: State,
+        batch_size: int = BATCH_SIZE, concurrency: int = CONCURRENCY
     ):
-        """Инициализирует курсор."""
+        """Инициализирует курсор.
+
+        Args:
+            batch_size (int): размер пачки при чтении из Postgres.
+            concurrency (int): число одновременных bulk-запросов в ES.
+        """
         self.conn = pg_conn
         self.cursor = self.conn.cursor()
         self.es = es_conn
         self.index_name = index_name
         self.state = state
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
 
-    def etl(self):
+    def etl(
+        self, since: Optional[dt.datetime] = None, save_state: bool = True
+    ) -> Tuple[int, int, dt.datetime]:
         """
         Процесс объединяющий все функции ETL.
 
         Extract: получает данные пачками из таблицы film_work.
         Transform: преобразует данные в понятный для Elastic Search формат.
         Load: загружает данные в Elastic Search.
+
+        Args:
+            since (datetime, optional): с какого момента брать изменения.
+            По умолчанию берётся last_modified из хранилища состояния.
+            save_state (bool): сохранять ли last_modified в хранилище.
+            reindex отключает сохранение: его индекс ещё может быть удалён.
+
+        Returns:
+            Tuple[int, int, datetime]: число загруженных и не загруженных
+            фильмов и достигнутый last_modified.
         """
         logger.info('Начат процесс ETL...')
 
-        last_modified = self._get_last_modified()
+        last_modified = since or self._get_last_modified()
 
         if not isinstance(last_modified, dt.datetime):
             logger.error("Некорректный тип last_modified")
             raise TypeError("last_modified должен быть datetime")
 
-        total_transformed = 0
-        max_modified = last_modified
+        progress = {
+            'loaded': 0,
+            'failed': 0,
+            'watermark': last_modified,
+            'blocked': False,
+        }
         self.execute_query(last_modified)
-        while True:
-            batch = self.get_data()
-            if not batch:
-                break
-            transformed_data = []
-            for row in batch:
-                try:
-                    doc = self.transform(list(row))
-                    if doc:
-                        transformed_data.append(doc)
-                        curr_mod = row[6].replace(tzinfo=dt.timezone.utc)
-                        if (curr_mod and curr_mod > max_modified):
-                            last_modified = curr_mod
-                    else:
-                        logger.warning("Transform вернул None.")
-                except Exception as err:
-                    logger.error(
-                        f"Ошибка при трансформации строки:{err}",
-                        exc_info=True
-                    )
-
-            if transformed_data:
-                try:
-                    self.load_data(transformed_data)
-                    total_transformed += len(transformed_data)
-                except Exception as e:
-                    logger.error(
-                        f"Ошибка при загрузке данных в ElasticSearch: {e}",
-                        exc_info=True
-                    )
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # Пачки завершаются строго в порядке отправки, чтобы
+            # last_modified не обогнал ещё не загруженные фильмы.
+            pending = deque()
+            while True:
+                batch = self.get_data()
+                if not batch:
+                    break
+                transformed_data = []
+                modified = []
+                for row in batch:
+                    if row[6]:
+                        modified.append(row[6].replace(tzinfo=dt.timezone.utc))
+                    try:
+                        doc = self.transform(list(row))
+                        if doc:
+                            transformed_data.append(doc)
+                        else:
+                            logger.warning("Transform вернул None.")
+                    except Exception as err:
+                        logger.error(
+                            f"Ошибка при трансформации строки:{err}",
+                            exc_info=True
+                        )
+
+                while len(pending) >= self.concurrency:
+                    self._finish_batch(progress, *pending.popleft())
+                pending.append((
+                    executor.submit(self.load_data, transformed_data),
+                    len(batch),
+                    min(modified, default=None),
+                    max(modified, default=None),
+                ))
+            while pending:
+                self._finish_batch(progress, *pending.popleft())
+
+        logger.info(
+            f"Загружено {progress['loaded']} документов, "
+            f"не загружено {progress['failed']}"
+        )
 
-            logger.info(f'Загружено {len(transformed_data)} документов')
+        watermark = progress['watermark']
+        if save_state and watermark > last_modified:
+            self.state.set_state('last_modified', watermark.isoformat())
+            logger.info(f"Обновлено last_modified: {watermark}")
 
-        if max_modified > last_modified:
-            self.state.set_state(
-                'last_modified', max_modified.isoformat())
-            logger.info(f"Обновлено last_modified: {max_modified}")
+        logger.info('ETL процесс завершён.')
+        return progress['loaded'], progress['failed'], watermark
 
-        logger.info('ETL процесс завершён успешно.')
+    def _finish_batch(
+        self, progress: dict, future: Future, size: int,
+        min_modified: Optional[dt.datetime],
+        max_modified: Optional[dt.datetime]
+    ) -> None:
+        """Дожидается загрузки пачки и сдвигает last_modified.
+
+        last_modified сдвигается только пока все предыдущие пачки
+        загружены полностью.
+        """
+        try:
+            loaded = future.result()
+        except Exception as e:
+            logger.error(
+                f"Ошибка при загрузке данных в ElasticSearch: {e}",
+                exc_info=True
+            )
+            loaded = 0
+        progress['loaded'] += loaded
+        progress['failed'] += size - loaded
+
+        if progress['blocked']:
+            return
+        if loaded < size:
+            progress['blocked'] = True
+            if min_modified and progress['watermark'] >= min_modified:
+                # Запрос берёт modified > last_modified, поэтому
+                # отступаем, чтобы не потерять фильмы с тем же modified.
+                progress['watermark'] = (
+                    min_modified - dt.timedelta(microseconds=1))
+        elif max_modified:
+            progress['watermark'] = max(progress['watermark'], max_modified)
 
     @backoff()
     def get_data(self) -> Generator[Any, Any, Any]:
         """Генератор извлекающий данные из Postgres пачками по batch."""
-        results = self.cursor.fetchmany(BATCH_SIZE)
+        results = self.cursor.fetchmany(self.batch_size)
         logger.info(f"Получено {len(results)} записей из PostgreSQL")
         return results
 
@@ -179,12 +245,20 @@ class ETL:
             raise
 
     @backoff()
-    def load_data(self, transformed_data: List[dict]) -> None:
+    def load_data(self, transformed_data: List[dict]) -> int:
         """Загружает отформатированные данные в Elastic Search.
 
+        Ошибки соединения, 429 и 5xx пробрасываются в backoff и
+        повторяются. Остальные ошибки ES (4xx, в том числе 413 при большом
+        batch_size) и ошибки отдельных документов считаются незагруженными
+        фильмами: повтор их не исправит.
+
         Args:
             transformed_data (List[dict]): список словарей с
             информацией о фильме.
+
+        Returns:
+            int: число успешно загруженных фильмов.
         """
         bulk_data = []
         for document in transformed_data:
@@ -197,29 +271,62 @@ class ETL:
                 }
             })
             bulk_data.append(document)
-        if bulk_data:
-            try:
-                response = self.es.bulk(
-                    index=self.index_name,
-                    body='\n'.join(json.dumps(doc) for doc in bulk_data) + '\n'
-                )
-                if response.get('errors'):
-                    logger.error(f'В bulk произошла ошибка {response}')
-                else:
-                    logger.info(
-                        f'Успешно перенесено {len(transformed_data)} фильмов.')
-            except Exception as err:
-                logger.error(
-                    f'Ошибка при попытке загрузить данные в ES: {err}')
-        else:
+        if not bulk_data:
             logger.info('Нет данных для загрузки в ES')
+            return 0
+
+        from elasticsearch import ApiError, ConnectionError, ConnectionTimeout
+
+        try:
+            response = self.es.bulk(
+                index=self.index_name,
+                body='\n'.join(json.dumps(doc) for doc in bulk_data) + '\n'
+            )
+        except (ConnectionError, ConnectionTimeout):
+            raise
+        except ApiError as err:
+            if err.status_code == 429 or err.status_code >= 500:
+                raise
+            logger.error(
+                f'ES отклонил bulk из {len(transformed_data)} фильмов: {err}')
+            return 0
+        if not response.get('errors'):
+            logger.info(
+                f'Успешно перенесено {len(transformed_data)} фильмов.')
+            return len(transformed_data)
+
+        errors = [
+            item['index']['error'] for item in response['items']
+            if item['index'].get('error')
+        ]
+        logger.error(
+            f'В bulk не загружено {len(errors)} фильмов, '
+            f'первая ошибка: {errors[0] if errors else response}'
+        )
+        return len(response['items']) - len(errors)
 
     def _get_last_modified(self) -> dt.datetime:
-        last_modified_str = self.state.get_state('last_modified')
-        if last_modified_str:
-            try:
-                return dt.datetime.fromisoformat(
-                    last_modified_str).replace(tzinfo=dt.timezone.utc)
-            except ValueError:
-                return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
-        return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+        return parse_last_modified(self.state.get_state('last_modified'))
+
+
+def parse_last_modified(last_modified_str: Optional[str]) -> dt.datetime:
+    """Разбирает сохранённый last_modified, по умолчанию datetime.min."""
+    if last_modified_str:
+        try:
+            return dt.datetime.fromisoformat(
+                last_modified_str).replace(tzinfo=dt.timezone.utc)
+        except ValueError:
+            return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+    return dt.datetime.min.replace(tzinfo=dt.timezone.utc)
+
+
+def rewind_last_modified(state: State, watermark: dt.datetime) -> None:
+    """Сдвигает сохранённый last_modified назад до watermark.
+
+    Вперёд состояние не двигается: всё, что изменилось после watermark,
+    будет перечитано следующим проходом.
+    """
+    stored = parse_last_modified(state.get_state('last_modified'))
+    if watermark < stored:
+        state.set_state('last_modified', watermark.isoformat())
+        logger.info(f"last_modified сдвинут назад: {stored} -> {watermark}")
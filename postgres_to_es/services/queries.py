@@ -27,3 +27,7 @@ main_query = """
     GROUP BY fw.id
     ORDER BY fw.modified
 """
+
+count_query = """
+    SELECT COUNT(*) FROM content.film_work
+"""